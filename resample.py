@@ -1,14 +1,52 @@
 import os
 import sys
 import click
-import copy
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from rasterio.enums import Resampling
 from rasterio import Affine
-from scipy.ndimage import zoom
+from rasterio.windows import Window
+from typing import Callable
+import cv2
+import numba
 import numpy as np
 import rasterio as rio
 
 
+logger = logging.getLogger(__name__)
+
+# Edge length of the square tiles of the output GTiffs (outputs are resampled and written tile by tile)
+BLOCK_SIZE = 256
+
+# OpenCV equivalents of the Rasterio resampling methods (used by the zoom resampler)
+cv2_methods = {
+    Resampling.nearest: cv2.INTER_NEAREST,
+    Resampling.bilinear: cv2.INTER_LINEAR,
+    Resampling.cubic: cv2.INTER_CUBIC,
+    Resampling.cubic_spline: cv2.INTER_CUBIC,
+    Resampling.lanczos: cv2.INTER_LANCZOS4,
+    Resampling.average: cv2.INTER_AREA
+}
+
+
+@numba.njit(nogil=True, cache=True)
+def nn_upsample_u16(src: np.ndarray, dst: np.ndarray, row_lut: np.ndarray, col_lut: np.ndarray) -> None:
+    """Nearest-Neighbor Resample a Band (2D NDArray) into a uint16 Block
+
+    :param src: Source band
+    :param dst: Output block to fill
+    :param row_lut: Source row of each row of the output block
+    :param col_lut: Source column of each column of the output block
+    """
+
+    for i in range(dst.shape[0]):
+        src_row = src[row_lut[i]]
+        for j in range(dst.shape[1]):
+            dst[i, j] = src_row[col_lut[j]]
+
+
 def resample_band(dataset: rio.io.DatasetReader,
                   target_resolution: float,
                   resampling_method: Resampling,
@@ -17,20 +55,24 @@ def resample_band(dataset: rio.io.DatasetReader,
 
     :param dataset: Input dataset
     :param target_resolution: Resolution of the output dataset: what you want to resample to
-    :param resampling_method: Which method to use for resampling (only applicable to rasterio!)
-    :param resampler: Which resampling function to use (e.g. Rasterio vs SciPy zoom)
-    :return: Dictionary containing resampled data ("data") and the resampled profile ("profile")
+    :param resampling_method: Which method to use for resampling
+    :param resampler: Which resampling function to use (e.g. Rasterio vs zoom)
+    :return: Dictionary containing a function that resamples a window of the output ("read_block") and the
+        resampled profile ("profile")
     """
 
     # Calculate scale factor
-    scaling = int(dataset.res[0]) / float(target_resolution)
+    scaling = dataset.res[0] / float(target_resolution)
 
     # Calculate profile and transfor elements
-    profile = copy.deepcopy(dataset.profile)
-    trans = copy.deepcopy(dataset.transform)
+    # (the transform and dimensions are immutable, so only the profile needs copying)
+    profile = dataset.profile.copy()
+    trans = dataset.transform
     transform = Affine(trans.a / scaling, trans.b, trans.c, trans.d, trans.e / scaling, trans.f)
-    height = copy.deepcopy(dataset.height) * scaling
-    width = copy.deepcopy(dataset.width) * scaling
+    # (truncated so that the output never reaches past the source, with an epsilon as e.g. 20m -> 30m would otherwise
+    # lose a row/column to floating point error)
+    height = int(dataset.height * scaling + 1e-9)
+    width = int(dataset.width * scaling + 1e-9)
     profile.update(
         res=(float(target_resolution), float(target_resolution)),
         transform=transform,
@@ -39,47 +81,132 @@ def resample_band(dataset: rio.io.DatasetReader,
     )
 
     # Resample data to target resolution
-    if resampler is "rasterio":
-        print("[INFO] Using Rasterio resampler...")
-        resampled = dataset.read(
-            out_shape=(
-                dataset.count,
-                int(height),
-                int(width)
-            ),
-            resampling=resampling_method
-        )
+    if resampler not in ("rasterio", "zoom"):
+        logger.warning("Unknown resampler %s! Falling back to the Rasterio resampler.", resampler)
+        resampler = "rasterio"
+
+    if resampler == "rasterio":
+        logger.info("Using Rasterio resampler...")
+
+        def read_block(window: Window) -> np.ndarray:
+            # Only read (and resample) the part of the source covered by the output window
+            src_window = Window(
+                window.col_off / scaling,
+                window.row_off / scaling,
+                window.width / scaling,
+                window.height / scaling
+            )
+            return dataset.read(
+                window=src_window,
+                out_shape=(
+                    dataset.count,
+                    window.height,
+                    window.width
+                ),
+                resampling=resampling_method,
+                out_dtype=rio.uint16
+            )
     else:
-        print("[INFO] Using scipy zoom resampler...")
-        print("[WARNING] Zoom resampler does not honor resampling methods! Use the Rasterio resampler for this!")
+        logger.info("Using zoom resampler...")
+        if resampling_method not in cv2_methods:
+            logger.warning("Zoom resampler does not support %s! Falling back to nearest-neighbor.",
+                           resampling_method.name)
+        interpolation = cv2_methods.get(resampling_method, cv2.INTER_NEAREST)
         raw_read = dataset.read()
-        resampled = np.array(list(map(
-            lambda layer: zoom(layer, scaling, order=0, mode='nearest'),
-            raw_read
-        )))
+
+        if interpolation == cv2.INTER_NEAREST:
+            # Source pixel of each output row/column, floor(i * src / dst) as OpenCV does (up to floating-point
+            # error), so that each block can be resampled on its own
+            row_lut = np.arange(height) * dataset.height // height
+            col_lut = np.arange(width) * dataset.width // width
+
+            def read_block(window: Window) -> np.ndarray:
+                row_slice, col_slice = window.toslices()
+                block = np.empty((dataset.count, window.height, window.width), dtype=rio.uint16)
+                for i in range(dataset.count):
+                    nn_upsample_u16(raw_read[i], block[i], row_lut[row_slice], col_lut[col_slice])
+                return block
+        else:
+            # cv2.resize rejects some dtypes (e.g. int8, int32, uint32), so resample those as float32 (outputs are
+            # uint16 regardless)
+            if raw_read.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+                raw_read = raw_read.astype(np.float32)
+            resampled = np.empty((dataset.count, height, width), dtype=raw_read.dtype)
+            for i in range(raw_read.shape[0]):
+                # Note: OpenCV takes the output size as (width, height)
+                cv2.resize(raw_read[i], (width, height), dst=resampled[i], interpolation=interpolation)
+
+            def read_block(window: Window) -> np.ndarray:
+                row_slice, col_slice = window.toslices()
+                return resampled[:, row_slice, col_slice]
 
     # Create output dictionary
     output = {
-        "data": resampled,
+        "read_block": read_block,
         "profile": profile
     }
 
     return output
 
 
-def write_resampled(data: np.ndarray, path: str, profile: rio.profiles.Profile) -> None:
+def produce_blocks(read_block: Callable[[Window], np.ndarray],
+                   windows: list,
+                   blocks: queue.Queue,
+                   abort: threading.Event) -> None:
+    """Resample Blocks for a Writer
+
+    :param read_block: Function returning the data of the dataset within a window
+    :param windows: Windows to resample, in write order
+    :param blocks: Queue to put (window, data) pairs on, followed by None once done (or failed)
+    :param abort: Event signalling that the writer has given up and no more blocks are wanted
+    """
+
+    try:
+        # The source is read from this thread, and Rasterio environments are per thread, so enter one here too
+        with rio.Env():
+            for window in windows:
+                if abort.is_set():
+                    break
+                blocks.put((window, read_block(window)))
+    finally:
+        blocks.put(None)
+
+
+def write_resampled(read_block: Callable[[Window], np.ndarray], path: str, profile: rio.profiles.Profile) -> None:
     """Write a Dataset to Disk
 
-    :param data: Dataset to be written
+    The dataset is written block by block, while the next blocks are resampled in a background thread, so
+    resampling and writing overlap and only a couple of blocks need to be in memory at a time.
+
+    :param read_block: Function returning the data of the dataset within a window
     :param path: Path of the output file
     :param profile: Profile of the dataset
     """
 
     with rio.open(path.encode('unicode-escape').decode(), 'w', **profile) as dst:
-        for band_num, data_arr in enumerate(data, start=1):
-            # print("Would have written to band {} in file {}".format(band_num, output_path))
-            dst.write_band(band_num, data_arr.astype(rio.uint16))
-        print("[INFO] Raster written to {}".format(path))
+        # Write along the file's own tile grid so that GDAL can write whole blocks, bypassing its block cache
+        windows = [window for _, window in dst.block_windows(1)]
+
+        # Bounded, so the resampler can only run two blocks ahead of the writer
+        blocks = queue.Queue(maxsize=2)
+        abort = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            producer = executor.submit(produce_blocks, read_block, windows, blocks, abort)
+            try:
+                for window, block in iter(blocks.get, None):
+                    # Blocks sliced out of a full resampled band are strided views: convert and compact them in a
+                    # single copy (a no-op for blocks that are already contiguous uint16)
+                    block = np.ascontiguousarray(block, dtype=rio.uint16)
+                    # All bands at once, so GDAL writes whole pixel-interleaved blocks in one call
+                    dst.write(block, window=window)
+            except BaseException:
+                # Stop the producer, and drain the queue so that it is not left blocked on a full queue
+                abort.set()
+                for _ in iter(blocks.get, None):
+                    pass
+                raise
+            producer.result()
+        logger.info("Raster written to %s", path)
 
 
 def load_and_resample(file: str,
@@ -95,49 +222,54 @@ def load_and_resample(file: str,
     :param naming_scheme: Base unit of output file names (e.g. "foo" in "foo_104.tiff")
     :param target_res: Resolution to resample to (e.g. "10" for "10 meters")
     :param resampling_method: Which resampling method to use (e.g. nearest-neighbor or bilinear)
-    :param resampler: Which resampling function set to use (e.g. Rasterio or SciPy zoom)
-    :return: A list of resampled datasets formatted as directories containing data and profiles
+    :param resampler: Which resampling function set to use (e.g. Rasterio or zoom)
+    :return: A list of the profiles of the resampled datasets, in subdataset order
     """
 
     if not os.path.isfile(file):
-        print('File ' + file + ' not found.')
+        logger.error('File %s not found.', file)
         sys.exit()
 
     with rio.open(file) as raw_ds:
         sds_paths = raw_ds.subdatasets
 
-    resampled_subdatasets = list(map(
-        lambda sds: resample_band(
-            rio.open(sds),
-            float(target_res),
-            resampling_method=resampling_method,
-            resampler=resampler
-        ),
-        sds_paths
-    ))
-
-    # New instance of GDAL/Rasterio
-    with rio.Env():
-        # Write an array as a raster band to a new 8-bit file. For
-        # the new file's profile, we start with the profile of the source
-        # profile = src.profile
-
-        # if len(resampled_subdatasets) > 0:
-        #     all_profile = resampled_subdatasets[0]["profile"]
-        #     all_profile.update(
-        #         driver="GTiff",
-        #         count=len(resampled_subdatasets)
-        #     )
-        # else:
-        #     raise RuntimeError("No resampled datasets returned! Check your script!")
-
-        # Read each resampled band and write it to stack
-        for ds_num, ds_dict in enumerate(resampled_subdatasets):
-            to_create = "/{}/{}_{}.tiff".format(output_path, naming_scheme, ds_num)
-            ds_dict["profile"].update(driver="GTiff", dtype=rio.uint16)
-            write_resampled(ds_dict["data"], to_create, ds_dict["profile"])
-
-    return resampled_subdatasets
+    def resample_and_write(ds_num: int, sds: str) -> rio.profiles.Profile:
+        # Rasterio environments are per thread, so each worker enters its own for opening its subdataset and writing
+        # its output (source blocks are read from write_resampled's producer thread, which enters its own as well)
+        with rio.Env():
+            with rio.open(sds) as dataset:
+                ds_dict = resample_band(
+                    dataset,
+                    float(target_res),
+                    resampling_method=resampling_method,
+                    resampler=resampler
+                )
+
+                to_create = "/{}/{}_{}.tiff".format(output_path, naming_scheme, ds_num)
+                ds_dict["profile"].update(
+                    driver="GTiff",
+                    dtype=rio.uint16,
+                    tiled=True,
+                    blockxsize=BLOCK_SIZE,
+                    blockysize=BLOCK_SIZE,
+                    interleave="pixel",
+                    compress="deflate",
+                    predictor=2,
+                    num_threads="ALL_CPUS",
+                    BIGTIFF="IF_SAFER"
+                )
+                write_resampled(ds_dict["read_block"], to_create, ds_dict["profile"])
+
+        return ds_dict["profile"]
+
+    # Fix the (process-wide) GDAL block cache at 512 MB, as blocks are only ever read or written once. This has to be
+    # set from the calling thread: the cache size is fixed before the workers' environments are entered
+    with rio.Env(GDAL_CACHEMAX=512 * 1024 * 1024):
+        # Subdatasets are independent, and GDAL releases the GIL for I/O and resampling, so threads suffice
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            resampled_profiles = list(executor.map(resample_and_write, range(len(sds_paths)), sds_paths))
+
+    return resampled_profiles
 
 
 @click.command()
@@ -151,28 +283,39 @@ def load_and_resample(file: str,
 @click.option("--target-resolution", '-t', required=True, default=10, help="The resolution to resample to")
 @click.option('--resampling-method',
               required=False,
-              type=click.Choice(['nearest', 'bilinear', 'cubic', 'cubicspline'], case_sensitive=False),
+              type=click.Choice(['nearest', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'average', 'mode'],
+                                case_sensitive=False),
               default='nearest',
               help="Which resampling method to use when resampling. Default is nearest-neighbor."
               )
 @click.option('--select-resampler',
               required=False,
               type=click.Choice(['rasterio', 'zoom'], case_sensitive=False),
-              default='zoom'
+              default='rasterio',
+              help="Which resampler to use. Default is Rasterio (GDAL), which supports every resampling method."
               )
+@click.option('--verbose', '-v', is_flag=True, default=False, help="Log progress (only warnings are shown otherwise)")
 def main(source_path: str,
          output_path: str,
          naming_scheme: str,
          target_resolution: str,
          resampling_method: str,
-         select_resampler: str):
-    print("[INFO] --- Starting Resample... ---")
+         select_resampler: str,
+         verbose: bool):
+    logging.basicConfig(
+        level=logging.INFO if verbose else logging.WARNING,
+        format="[%(levelname)s] %(message)s"
+    )
+    logger.info("--- Starting Resample... ---")
 
     rs_methods = {
         "nearest": Resampling.nearest,
         "bilinear": Resampling.bilinear,
         "cubic": Resampling.cubic,
-        "cubicspline": Resampling.cubic_spline
+        "cubicspline": Resampling.cubic_spline,
+        "lanczos": Resampling.lanczos,
+        "average": Resampling.average,
+        "mode": Resampling.mode
     }
 
     out = load_and_resample(
@@ -184,7 +327,7 @@ def main(source_path: str,
         resampler=select_resampler
     )
 
-    print("[INFO] --- Done. ---")
+    logger.info("--- Done. ---")
 
 
 if __name__ == '__main__':